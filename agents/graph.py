@@ -1,51 +1,139 @@
 from __future__ import annotations 
 
-from typing import Any
+import asyncio
+import functools
+
+from typing import Any, AsyncIterator, Tuple
 from langgraph.graph import StateGraph, END
 
 from schemas.state import AppState
-from agents.planner import run_planner
-from agents.researcher import run_research
+from agents.planner import PlanOut, run_planner
+from agents.researcher import ResearchOut, run_retrieval, run_research
 from agents.writer import run_writer
-from agents.verifier import run_verifier, should_reroute_to_research
+from agents.verifier import VerifierOut, run_verifier, should_reroute_to_research
+from tools import async_runtime
+from tools.coalescer import coalescer
+from tools.llm_batcher import get_structured
+
+
+async def run_plan_and_retrieve(state: AppState) -> AppState:
+    # Retrieval only needs the user task, so it runs concurrently with the planner
+    await asyncio.gather(run_planner(state), run_retrieval(state))
+    return state
 
 
 def build_graph():
     graph = StateGraph(AppState)
 
     # Register workflow nodes
-    graph.add_node("planner", run_planner)
+    graph.add_node("plan_and_retrieve", run_plan_and_retrieve)
+    graph.add_node("retrieve", run_retrieval)
     graph.add_node("research", run_research)
     graph.add_node("writer", run_writer)
     graph.add_node("verifier", run_verifier)
 
     # Define execution flow
-    graph.set_entry_point("planner")
-    graph.add_edge("planner", "research")
+    graph.set_entry_point("plan_and_retrieve")
+    graph.add_edge("plan_and_retrieve", "research")
+    graph.add_edge("retrieve", "research")
     graph.add_edge("research", "writer")
     graph.add_edge("writer", "verifier")
 
-    # Conditional routing after verification
+    # Conditional routing after verification (retries re-run retrieval before research)
     graph.add_conditional_edges(
         "verifier",
         should_reroute_to_research,
-        {"research": "research", "end": END},
+        {"research": "retrieve", "end": END},
     )
 
     return graph.compile()
 
 
+async def _warm_schema(model: str, schema) -> None:
+    # Building the runnable can fail too (e.g. missing OPENAI_API_KEY), so it happens in here
+    try:
+        await get_structured(model, schema).ainvoke([("human", "Return a minimal valid example.")])
+    except Exception:
+        pass  # Best effort: a failed warm-up only means the first real call compiles the schema
+
+
+async def warm_structured_outputs(model: str) -> None:
+    # The first request with a new strict schema pays for server-side grammar compilation;
+    # send one tiny request per schema up front so real tasks don't (failures are ignored)
+    await asyncio.gather(*(_warm_schema(model, schema) for schema in (PlanOut, ResearchOut, VerifierOut)))
+
+
+@functools.lru_cache(maxsize=1)
+def compiled_graph():
+    # The topology is static, so compile once per process and reuse it
+    return build_graph()
+
+
 def _ensure_app_state(x: Any) -> AppState:
     # Ensure the result is returned as AppState
     if isinstance(x, AppState):
         return x
     if isinstance(x, dict):
-        return AppState(**x)
+        # Values coming out of the graph were already validated by the nodes
+        return AppState.model_construct(**x)
     raise TypeError(f"Unexpected state type: {type(x)}")
 
 
-def run_task(user_task: str, persist_dir: str = "data/chroma", model: str = "gpt-4o-mini") -> AppState:
-    app = build_graph()
-    state = AppState(user_task=user_task, meta={"persist_dir": persist_dir, "model": model})
-    result = app.invoke(state)
-    return _ensure_app_state(result)
+async def run_task_async(user_task: str, persist_dir: str = "data/chroma", model: str = "gpt-4o-mini", app=None) -> AppState:
+    app = app or compiled_graph()
+
+    async def _run() -> AppState:
+        state = AppState(user_task=user_task, meta={"persist_dir": persist_dir, "model": model})
+        result = await app.ainvoke(state)
+        return _ensure_app_state(result)
+
+    # Near-duplicate tasks already running in another session share that run's result
+    return await coalescer.run(user_task, persist_dir, model, _run)
+
+
+def run_task(user_task: str, persist_dir: str = "data/chroma", model: str = "gpt-4o-mini", app=None) -> AppState:
+    # Synchronous entry point for callers without an event loop (eval scripts, CLI); runs on the
+    # shared loop so cached LLM clients are never reused across loops
+    return async_runtime.run(run_task_async(user_task, persist_dir=persist_dir, model=model, app=app))
+
+
+async def astream_task(
+    user_task: str, persist_dir: str = "data/chroma", model: str = "gpt-4o-mini", app=None
+) -> AsyncIterator[Tuple[str, Any]]:
+    """
+    Run the workflow while streaming the writer's tokens.
+    Yields ("token", str) for each draft chunk and finally ("state", AppState).
+    """
+    app = app or compiled_graph()
+
+    # Near-duplicate tasks already running in another session share that run's result
+    # (the follower gets no tokens, only the final state)
+    leader, task = await coalescer.acquire(user_task, persist_dir, model)
+    if not leader:
+        yield "state", await coalescer.wait(task, user_task)
+        return
+
+    try:
+        state = AppState(user_task=user_task, meta={"persist_dir": persist_dir, "model": model})
+        final: Any = state
+        writer_step = None
+        async for mode, payload in app.astream(state, stream_mode=["messages", "values"]):
+            if mode == "values":
+                final = payload
+                continue
+            chunk, metadata = payload
+            if metadata.get("langgraph_node") != "writer" or not chunk.content:
+                continue
+            # Separate drafts when the verifier sends the workflow back through the writer
+            step = metadata.get("langgraph_step")
+            if writer_step is not None and step != writer_step:
+                yield "token", "\n\n---\n\n"
+            writer_step = step
+            yield "token", chunk.content
+        result = _ensure_app_state(final)
+    except BaseException as e:
+        coalescer.release(task, error=e)
+        raise
+
+    coalescer.release(task, result=result)
+    yield "state", result
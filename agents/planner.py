@@ -1,14 +1,16 @@
 from __future__ import annotations  
 
+import asyncio
 import time
 
 from typing import List
 from pydantic import BaseModel, Field
 
-from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 
 from schemas.state import AppState
+from tools import semcache
+from tools.llm_batcher import batcher
 
 
 class PlanOut(BaseModel):
@@ -39,27 +41,37 @@ PROMPT = ChatPromptTemplate.from_messages(
 )
 
 
-def run_planner(state: AppState) -> AppState:
-    t0 = time.time()  # Start latency measurement
-
-    # Initialize LLM with deterministic output (temperature=0)
-    llm = ChatOpenAI(model=state.meta.get("model", "gpt-4o-mini"), temperature=0)
-    structured = llm.with_structured_output(PlanOut)  # Enforce structured JSON output
-
-    # Invoke the model with formatted prompt messages
-    out: PlanOut = structured.invoke(
-        PROMPT.format_messages(user_task=state.user_task)
-    )
-
-    state.plan = out.steps  # Save generated plan into state
-    state.log("planner", "created plan", f"{len(out.steps)} steps")
-
-    # Observability: track execution latency and errors
-    obs = state.meta.setdefault('observability', [])
-    obs.append({
-        'agent': 'planner',
-        'latency_s': round(time.time() - t0, 3),
-        'error': None,
-    })
-
-    return state
+async def run_planner(state: AppState) -> AppState:
+    t0 = time.perf_counter()  # Start latency measurement (monotonic)
+    error = None
+    try:
+        persist_dir = state.meta.get("persist_dir", "data/chroma")
+        model = state.meta.get("model", "gpt-4o-mini")
+
+        # Reuse the plan of a near-duplicate task when the semantic cache has one
+        cached, vector = await asyncio.to_thread(
+            semcache.lookup, persist_dir, "planner", model, state.user_task, SYSTEM
+        )
+        if cached:
+            out = PlanOut.model_validate_json(cached)
+            state.plan = out.steps
+            state.log("planner", "created plan", f"{len(out.steps)} steps (cache hit)")
+        else:
+            # Invoke the model with formatted prompt messages (deterministic, temperature=0)
+            out: PlanOut = await batcher.submit(
+                model, PROMPT.format_messages(user_task=state.user_task), PlanOut
+            )
+            # Reuses the lookup's embedding and is not awaited
+            semcache.store_background(
+                persist_dir, "planner", model, state.user_task, out.model_dump_json(), SYSTEM, vector
+            )
+
+            state.plan = out.steps  # Save generated plan into state
+            state.log("planner", "created plan", f"{len(out.steps)} steps")
+        return state
+    except Exception as e:
+        error = repr(e)
+        raise
+    finally:
+        # Observability: track execution latency and errors
+        state.record_obs('planner', t0, error)
@@ -1,20 +1,48 @@
 from __future__ import annotations 
 
+import asyncio
 import time
+from typing import Optional
 
 from pydantic import BaseModel, Field
 
-from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableConfig
 
 from schemas.state import AppState
+from tools import semcache
+from tools.llm_batcher import batcher, get_llm
 
 
 class WriterOut(BaseModel):
-    # Structured output schema for the writer
+    # Writer result schema (used as the semantic cache payload)
     draft_markdown: str = Field(..., description="Client-ready deliverable in Markdown.")
 
 
+# Mandatory headings, in the order the prompt requires them
+REQUIRED_HEADINGS = ("## Executive Summary", "## Client-ready Email", "## Action List", "## Sources")
+
+# Safe fallback draft used when research found no evidence (makes no factual claims)
+NOT_FOUND_DRAFT = (
+    "## Deliverable\n\n"
+    "**Not found in sources.** The document knowledge base did not contain "
+    "enough evidence to complete this request.\n\n"
+    "### What I need\n"
+    "- The relevant docs (or excerpts) that mention the required facts.\n"
+    "- Or clarify which document set to search.\n"
+)
+
+# state.meta key holding (cache context, task embedding) for a draft awaiting verification
+CACHE_PENDING_KEY = "writer_cache_pending"
+
+# state.meta flag set when the stream was aborted as malformed; the verifier fails the draft
+# without an LLM call and routes straight to a retry
+ABORTED_KEY = "writer_aborted"
+
+# A well-formed draft opens with the Executive Summary; give up if it has not appeared by then
+MAX_CHARS_BEFORE_SUMMARY = 600
+
+
 # System instructions for the writer agent (rewritten to avoid plagiarism)
 SYSTEM = """You are the Writer Agent (Operations Consultant).
 
@@ -52,46 +80,101 @@ PROMPT = ChatPromptTemplate.from_messages(
 )
 
 
-def run_writer(state: AppState) -> AppState:
-    t0 = time.time()  # Start latency measurement
-    llm = ChatOpenAI(model=state.meta.get("model", "gpt-4o-mini"), temperature=0)
-    structured = llm.with_structured_output(WriterOut)  # Enforce structured output
-
-    if not state.research_notes or state.research_notes.status != "ok":
-        # Produce a safe fallback draft when evidence is missing
-        state.draft_output = (
-            "## Deliverable\n\n"
-            "**Not found in sources.** The document knowledge base did not contain "
-            "enough evidence to complete this request.\n\n"
-            "### What I need\n"
-            "- The relevant docs (or excerpts) that mention the required facts.\n"
-            "- Or clarify which document set to search.\n"
-        )
-        state.log("writer", "drafted deliverable", "insufficient research")
-
-    # Observability: record latency and error status for this agent run
-    obs = state.meta.setdefault('observability', [])
-    obs.append({
-        'agent': 'writer',
-        'latency_s': round(time.time() - t0, 3),
-        'error': None,
-    })
-    return state
-    # Format notes compactly
-    notes_lines = []
-    for i, f in enumerate(state.research_notes.facts, start=1):
-        cite_str = "; ".join([f"{c.doc_id} ({c.location})" for c in f.citations])
-        notes_lines.append(f"{i}. {f.fact}\n   - Cites: {cite_str}")
-    notes_text = "\n".join(notes_lines)
-
-    out: WriterOut = structured.invoke(
-        PROMPT.format_messages(
-            user_task=state.user_task,
-            plan="\n".join(f"- {s}" for s in state.plan),
-            research_notes=notes_text,
-        )
+def cache_verified_draft(state: AppState, pending) -> None:
+    # Called by the verifier on "pass" with the entry popped from CACHE_PENDING_KEY
+    context, vector = pending
+    semcache.store_background(
+        state.meta.get("persist_dir", "data/chroma"),
+        "writer",
+        state.meta.get("model", "gpt-4o-mini"),
+        state.user_task,
+        WriterOut(draft_markdown=state.draft_output or "").model_dump_json(),
+        context,
+        vector,
     )
 
-    state.draft_output = out.draft_markdown  # Save generated markdown draft
-    state.log("writer", "drafted deliverable", "markdown draft created")
-    return state
+
+async def run_writer(state: AppState, config: Optional[RunnableConfig] = None) -> AppState:
+    t0 = time.perf_counter()  # Start latency measurement (monotonic)
+    error = None
+    try:
+        if not state.research_notes or state.research_notes.status != "ok":
+            # Produce a safe fallback draft when evidence is missing
+            state.draft_output = NOT_FOUND_DRAFT
+            state.log("writer", "drafted deliverable", "insufficient research")
+            return state
+
+        # Format notes compactly
+        notes_lines = []
+        for i, f in enumerate(state.research_notes.facts, start=1):
+            cite_str = "; ".join([f"{c.doc_id} ({c.location})" for c in f.citations])
+            notes_lines.append(f"{i}. {f.fact}\n   - Cites: {cite_str}")
+        notes_text = "\n".join(notes_lines)
+        plan_text = "\n".join(f"- {s}" for s in state.plan or [])
+
+        # The cache context pins everything except the user task, so a hit implies identical evidence
+        persist_dir = state.meta.get("persist_dir", "data/chroma")
+        model = state.meta.get("model", "gpt-4o-mini")
+        context = f"{SYSTEM}\n{plan_text}\n{notes_text}"
+
+        # Skip the cache on retries: the cached draft is what the verifier just rejected
+        cached, vector = None, None
+        if state.verifier_fail_count == 0:
+            cached, vector = await asyncio.to_thread(
+                semcache.lookup, persist_dir, "writer", model, state.user_task, context
+            )
+        if cached:
+            out = WriterOut.model_validate_json(cached)
+            state.draft_output = out.draft_markdown
+            state.log("writer", "drafted deliverable", "markdown draft reused (cache hit)")
+            return state
+
+        # Plain-text streaming so the UI can render the draft token by token
+        llm = get_llm(model, streaming=True)
+
+        parts = []
+        size = 0
+        summary_seen = False
+        aborted = False
+        # Streaming bypasses batcher.submit, but shares its rate limit and concurrency cap
+        async with batcher.slot():
+            async for chunk in llm.astream(
+                PROMPT.format_messages(
+                    user_task=state.user_task,
+                    plan=plan_text,
+                    research_notes=notes_text,
+                ),
+                config=config,  # Lets LangGraph's "messages" stream mode see the tokens on Python < 3.11
+            ):
+                parts.append(chunk.content)
+                size += len(chunk.content)
+                # Incremental validation: stop paying for tokens once the layout is clearly wrong
+                if not summary_seen:
+                    summary_seen = REQUIRED_HEADINGS[0] in "".join(parts)
+                    if not summary_seen and size > MAX_CHARS_BEFORE_SUMMARY:
+                        aborted = True
+                        break
+
+        draft = "".join(parts)
+        state.draft_output = draft  # Save generated markdown draft
+        if aborted:
+            state.meta[ABORTED_KEY] = True
+            state.log("writer", "drafted deliverable", "malformed draft; stream aborted")
+            return state
+
+        # Cached only once the verifier accepts it (see cache_verified_draft), so a rejected
+        # draft is never served to the next near-duplicate task
+        state.meta[CACHE_PENDING_KEY] = (context, vector)
+
+        missing = [h for h in REQUIRED_HEADINGS if h not in draft]
+        if missing:
+            state.log("writer", "drafted deliverable", f"markdown draft created (missing: {', '.join(missing)})")
+        else:
+            state.log("writer", "drafted deliverable", "markdown draft created")
+        return state
+    except Exception as e:
+        error = repr(e)
+        raise
+    finally:
+        # Observability: record latency and error status exactly once per run, whichever path returned
+        state.record_obs('writer', t0, error)
@@ -3,10 +3,9 @@ import html
 
 import os
 import shutil
-import hashlib
 from pathlib import Path
 import sys
-from typing import Optional, Any
+from typing import Any, Dict, Iterator, List, Tuple
 
 ROOT = Path(__file__).resolve().parents[1]  # Project root (multi-agent/)
 if str(ROOT) not in sys.path:
@@ -14,16 +13,17 @@ if str(ROOT) not in sys.path:
 
 import streamlit as st
 from dotenv import load_dotenv
-from tools.retriever import build_or_update_index
-from agents.graph import run_task
-from schemas.state import AppState
+from tools import async_runtime
+from tools.coalescer import coalescer
+from tools.retriever import build_or_update_index, reset_clients
+from agents.graph import astream_task, compiled_graph, warm_structured_outputs
+from schemas.state import AppState, dedupe_citations
 
 load_dotenv()  # Load environment variables (e.g., API keys, default model)
 
 APP_TITLE = "Enterprise Multi-Agent Copilot "
 SAMPLE_DOCS_DIR = Path("data/sample_docs")
 CHROMA_DIR = Path("data/chroma")
-FINGERPRINT_FILE = CHROMA_DIR / ".fingerprint"
 
 
 
@@ -93,49 +93,16 @@ def ensure_dirs() -> None:
     CHROMA_DIR.mkdir(parents=True, exist_ok=True)
 
 
-def sha256_file(p: Path) -> str:
-    # Hash file contents (streamed) to support stable fingerprints for incremental indexing
-    h = hashlib.sha256()
-    with p.open("rb") as f:
-        for chunk in iter(lambda: f.read(1024 * 1024), b""):
-            h.update(chunk)
-    return h.hexdigest()
+@st.cache_data(show_spinner=False, ttl=2)
+def _scan_docs(root: str, mtime_ns: int) -> List[str]:
+    # Recursive listing cached per directory mtime; the short TTL covers changes in nested folders
+    return sorted(str(p) for p in Path(root).rglob("*") if p.is_file())
 
 
-def docs_fingerprint(doc_dir: Path) -> str:
-    # Compute a deterministic fingerprint across all files (name + content hash)
-    files = sorted([p for p in doc_dir.rglob("*") if p.is_file()])
-    h = hashlib.sha256()
-    for p in files:
-        h.update(p.name.encode("utf-8"))
-        h.update(sha256_file(p).encode("utf-8"))
-    return h.hexdigest()
-
-
-def read_fingerprint() -> Optional[str]:
-    # Read the previous fingerprint to detect whether documents have changed
-    if FINGERPRINT_FILE.exists():
-        v = FINGERPRINT_FILE.read_text(encoding="utf-8").strip()
-        return v or None
-    return None
-
-
-def dedupe_citations(citations: list) -> list:
-    # Remove duplicate citations for cleaner UI rendering
-    seen = set()
-    out = []
-    for c in citations or []:
-        key = (c.doc_id, c.location, c.snippet)  # Stable identity for a citation instance
-        if key not in seen:
-            seen.add(key)
-            out.append(c)
-    return out
-
-
-def write_fingerprint(fp: str) -> None:
-    # Persist the fingerprint for fast "index up-to-date" checks
-    CHROMA_DIR.mkdir(parents=True, exist_ok=True)
-    FINGERPRINT_FILE.write_text(fp, encoding="utf-8")
+def list_doc_files() -> List[Path]:
+    # Single source of truth for the docs on disk, shared by the sidebar and the indexer
+    ensure_dirs()
+    return [Path(p) for p in _scan_docs(str(SAMPLE_DOCS_DIR), SAMPLE_DOCS_DIR.stat().st_mtime_ns)]
 
 
 def save_uploaded_files(uploaded_files) -> int:
@@ -155,36 +122,59 @@ def clear_docs_and_index() -> None:
     if SAMPLE_DOCS_DIR.exists():
         shutil.rmtree(SAMPLE_DOCS_DIR)
     if CHROMA_DIR.exists():
+        reset_clients()  # Cached clients would otherwise point at the deleted store
         shutil.rmtree(CHROMA_DIR)
     ensure_dirs()
 
 
 def ensure_index_ready() -> str:
     # Ensure the vector index is built and current for the docs on disk
-    ensure_dirs()
-    doc_files = [p for p in SAMPLE_DOCS_DIR.rglob("*") if p.is_file()]
+    doc_files = list_doc_files()
     if not doc_files:
         return "No docs uploaded yet."
 
-    current = docs_fingerprint(SAMPLE_DOCS_DIR)
-    previous = read_fingerprint()
-    if previous == current:
+    # The index tracks per-file content hashes itself (stat-cached), so an unchanged
+    # knowledge base costs a stat per file and no embedding calls
+    _, num = build_or_update_index(str(SAMPLE_DOCS_DIR), str(CHROMA_DIR), files=doc_files)
+    if not num:
         return "Index is up to date."
-
-    _, num = build_or_update_index(str(SAMPLE_DOCS_DIR), str(CHROMA_DIR))
-    write_fingerprint(current)
     return f"Indexed {num} chunks (docs changed)."
 
 
 
-# LangGraph return normalization
+# LangGraph helpers
+
+@st.cache_resource(show_spinner=False)
+def get_graph():
+    # Keep a single compiled workflow alive across reruns and sessions
+    return compiled_graph()
+
+
+@st.cache_resource(show_spinner=False)
+def warm_up(model: str):
+    # Starts once per model per process on the shared background loop; never blocks rendering
+    return async_runtime.submit(warm_structured_outputs(model))
+
+
+def stream_task(user_task: str, model: str, holder: Dict[str, AppState]) -> Iterator[str]:
+    # Bridge the async workflow stream into the sync generator st.write_stream expects;
+    # the final state is handed back through `holder`. The stream runs on the process-wide
+    # loop shared by every session, where the cached LLM clients live
+    agen = astream_task(user_task=user_task, persist_dir=str(CHROMA_DIR), model=model, app=get_graph())
+    for kind, payload in async_runtime.iterate(agen):
+        if kind == "token":
+            yield payload
+        else:
+            holder["state"] = payload
+
 
 def as_app_state(x: Any) -> AppState:
     # Normalize workflow output into AppState for consistent downstream handling
     if isinstance(x, AppState):
         return x
     if isinstance(x, dict):
-        return AppState(**x)
+        # Values coming out of the graph were already validated by the nodes
+        return AppState.model_construct(**x)
     raise TypeError(f"Unexpected state type: {type(x)}")
 
 
@@ -204,6 +194,24 @@ def init_session() -> None:
 
 # UI helpers
 
+@st.cache_data(show_spinner=False)
+def render_citations_html(keys: Tuple[Tuple[str, str, str], ...]) -> str:
+    # Build all citation blocks once per citation list and emit them as a single markdown call
+    doc_ids, locations, snippets = zip(*keys)
+    return "".join(
+        f'<div class="cite">'
+        f'<div class="meta"><b>[{i}]</b> <code>{d}</code> — {loc}</div>'
+        f'<div class="snippet">{snip}</div>'
+        f"</div>"
+        for i, d, loc, snip in zip(
+            range(1, len(keys) + 1),
+            map(html.escape, doc_ids),
+            map(html.escape, locations),
+            map(html.escape, snippets),
+        )
+    )
+
+
 def render_latest_details_under_answer(state: AppState) -> None:
     """
     Render supporting artifacts (citations, plan, trace, observability) under the latest answer.
@@ -217,20 +225,10 @@ def render_latest_details_under_answer(state: AppState) -> None:
         unique_cites = dedupe_citations(state.citations)
 
         if unique_cites:
-            for i, c in enumerate(unique_cites, start=1):
-                st.markdown(
-                    f"""
-<div class="cite">
-  <div class="meta"><b>[{i}]</b> <code>{c.doc_id}</code> — {c.location}</div>
-  <div class="snippet">{html.escape(c.snippet)}</div>
-
-</div>
-                    """,
-                    unsafe_allow_html=True,
-                )
+            keys = tuple((c.doc_id, c.location, c.snippet) for c in unique_cites)
+            st.markdown(render_citations_html(keys), unsafe_allow_html=True)
         else:
             st.markdown("<div class='small'>No citations (likely: Not found in sources).</div>", unsafe_allow_html=True)
-        st.markdown("</div>", unsafe_allow_html=True)
 
     with tabs[1]:
         if state.plan:
@@ -238,23 +236,31 @@ def render_latest_details_under_answer(state: AppState) -> None:
                 st.write(f"{i}. {step}")
         else:
             st.write("_No plan_")
-        st.markdown("</div>", unsafe_allow_html=True)
 
     with tabs[2]:
         if state.agent_logs:
-            st.dataframe([e.model_dump() for e in state.agent_logs], use_container_width=True, height=260)
+            rows = [
+                {"timestamp": e.timestamp, "agent": e.agent, "action": e.action, "outcome": e.outcome}
+                for e in state.agent_logs
+            ]
+            st.dataframe(rows, use_container_width=True, height=260)
         else:
             st.write("_No logs_")
         st.write(f"Verifier retries: **{state.verifier_fail_count} / {state.verifier_max_retries}**")
-        st.markdown("</div>", unsafe_allow_html=True)
 
     with tabs[3]:
-        obs = state.meta.get("observability", [])
-        if obs:
+        obs = state.observability
+        if obs["agent"]:
             st.dataframe(obs, use_container_width=True, height=220)
         else:
             st.write("_No observability data_")
-        st.markdown("</div>", unsafe_allow_html=True)
+        # Process-wide: how often concurrent near-duplicate tasks shared one run
+        stats = coalescer.stats()
+        st.markdown(
+            f"<div class='small'>Coalesced runs: <b>{stats['coalesced_total']} / {stats['requests_total']}</b> "
+            f"(merge rate {stats['merge_rate']:.1%})</div>",
+            unsafe_allow_html=True,
+        )
 
 
 # -----------------------------
@@ -265,27 +271,23 @@ def main():
     inject_css()
     init_session()
     ensure_dirs()
+    get_graph()  # Compile the workflow at startup rather than on the first submitted task
 
     # Sidebar configuration and knowledge base status
     with st.sidebar:
         st.markdown("### Settings")
         model = st.text_input("Model", value=os.getenv("OPENAI_MODEL", "gpt-4o-mini"))
+        warm_up(model)
 
         st.markdown("---")
         st.markdown("### Knowledge base")
 
-        doc_count = len([p for p in SAMPLE_DOCS_DIR.rglob("*") if p.is_file()])
+        doc_count = len(list_doc_files())
         st.markdown(f"<div class='small'>Docs loaded: <b>{doc_count}</b></div>", unsafe_allow_html=True)
 
         if st.session_state.kb_status:
             st.info(st.session_state.kb_status)
 
-        doc_count = len([p for p in SAMPLE_DOCS_DIR.rglob("*") if p.is_file()])
-        st.markdown(f"<div class='small'>Docs: <b>{doc_count}</b></div>", unsafe_allow_html=True)
-
-        if st.session_state.kb_status:
-            st.info(st.session_state.kb_status)
-
     # Header
     st.markdown(
         """
@@ -319,12 +321,14 @@ def main():
         with st.spinner("Preparing knowledge base…"):
             st.session_state.kb_status = ensure_index_ready()
 
-        # Execute the multi-agent workflow
-        with st.spinner("Running agents…"):
-            result = run_task(user_task=user_task, persist_dir=str(CHROMA_DIR), model=model)
-            state = as_app_state(result)
+        # Execute the multi-agent workflow, streaming the writer's draft as it is generated
+        with st.chat_message("user"):
+            st.markdown(user_task)
+        holder: Dict[str, AppState] = {}
+        with st.chat_message("assistant"):
+            st.write_stream(stream_task(user_task, model, holder))
+        state = as_app_state(holder["state"])
 
-        state.citations = dedupe_citations(state.citations)
         st.session_state.last_state = state
 
         assistant_msg = state.final_output or state.draft_output or "_No output_"
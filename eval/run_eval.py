@@ -1,9 +1,27 @@
+import functools
+import hashlib
 import json
+import os
+import pickle
 import re
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, Dict, FrozenSet, List, Set
 from dotenv import load_dotenv
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True  # Faster C parser for the test config, if installed
+except Exception:
+    ORJSON_AVAILABLE = False
+
+try:
+    import ahocorasick
+    AHOCORASICK_AVAILABLE = True  # Single-pass multi-phrase matching, if pyahocorasick is installed
+except Exception:
+    AHOCORASICK_AVAILABLE = False
+
 load_dotenv()  # Initialize environment variables (API keys, config, etc.)
 
 
@@ -12,17 +30,45 @@ sys.path.append(str(Path(__file__).resolve().parents[1]))
 
 from agents.graph import run_task
 from schemas.state import AppState
+from tools.retriever import build_or_update_index
 
 
 TEST_FILE = Path(__file__).parent / "test_cases.json"  # Location of test case definitions
-CHROMA_DIR = Path(__file__).resolve().parents[1] / "data" / "chroma"  # Persistent vector database directory
+DATA_DIR = Path(__file__).resolve().parents[1] / "data"
+SAMPLE_DOCS_DIR = DATA_DIR / "sample_docs"  # Source documents indexed for retrieval
+
+# With EVAL_LOCAL_EMBED the vectors come from a different model, so they live in their own
+# index (built by main) instead of replacing the app's OpenAI-embedded one
+LOCAL_EMBED = bool(os.getenv("EVAL_LOCAL_EMBED"))
+CHROMA_DIR = DATA_DIR / ("chroma_local" if LOCAL_EMBED else "chroma")  # Persistent vector database directory
+
+MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")  # Same default model as the app
+
+# On-disk memo of run_task results, so unchanged tests don't re-spend tokens on re-runs;
+# EVAL_NO_CACHE=1 forces fresh runs, bypassing the agents' semantic cache as well
+CACHE_DIR = Path(__file__).parent / ".cache"
+USE_CACHE = not os.getenv("EVAL_NO_CACHE")
+if not USE_CACHE:
+    os.environ["SEMCACHE_DISABLED"] = "1"
+
+_WORD_RE = re.compile(r"\w+")  # Compiled once; used by word_count
+BYTES_SEARCH_MIN_CHARS = 512  # Below this, encoding the output costs more than it saves
+_NF_RE = re.compile(r"not found in sources|not documented")  # Either phrase, in one scan
+
+FAIL_FAST = os.getenv("FAIL_FAST") == "1"  # Stop evaluating a test at its first failing check
 
 
 # ----------------------------
 # Utility Functions
 # ----------------------------
 def normalize_state(result: Any) -> AppState:
-    # Convert execution result into AppState (handles dict or model instance)
+    # Convert execution result into AppState (handles dict or model instance);
+    # exact type checks cover the common cases, isinstance only catches subclasses
+    t = type(result)
+    if t is AppState:
+        return result
+    if t is dict:
+        return AppState(**result)
     if isinstance(result, AppState):
         return result
     if isinstance(result, dict):
@@ -30,101 +76,203 @@ def normalize_state(result: Any) -> AppState:
     raise TypeError(f"Unexpected state type: {type(result)}")
 
 
-def word_count(text: str) -> int:
-    # Basic tokenizer-based word counting (used for length validation)
-    return len(re.findall(r"\w+", text))
-
+@functools.lru_cache(maxsize=1)
+def _index_version() -> str:
+    # Changes whenever the indexed docs (or the embedder) change, which invalidates cached results
+    manifest = CHROMA_DIR / "supplychain_copilot.manifest.json"
+    return hashlib.sha256(manifest.read_bytes()).hexdigest() if manifest.exists() else ""
+
+
+@functools.lru_cache(maxsize=1)
+def _code_version() -> str:
+    # Hash of the pipeline sources (prompts, schemas, agent logic), so editing any of them
+    # invalidates cached results instead of reporting stale pass/fail
+    root = Path(__file__).resolve().parents[1]
+    h = hashlib.sha256()
+    for package in ("agents", "schemas", "tools"):
+        for path in sorted((root / package).rglob("*.py")):
+            h.update(path.relative_to(root).as_posix().encode("utf-8"))
+            h.update(path.read_bytes())
+    return h.hexdigest()
+
+
+def cached_run_task(task: str) -> AppState:
+    # run_task memoized on disk by (task, persist_dir, model, index version, pipeline code)
+    if not USE_CACHE:
+        return normalize_state(run_task(user_task=task, persist_dir=str(CHROMA_DIR), model=MODEL))
+
+    key = hashlib.sha256(
+        f"{task}|{CHROMA_DIR}|{MODEL}|{_index_version()}|{_code_version()}".encode("utf-8")
+    ).hexdigest()
+    path = CACHE_DIR / f"{key}.pkl"
+    if path.exists():
+        try:
+            return normalize_state(pickle.loads(path.read_bytes()))
+        except Exception:
+            pass  # Stale or partial entry (e.g. schema changed): recompute and overwrite
+
+    state = normalize_state(run_task(user_task=task, persist_dir=str(CHROMA_DIR), model=MODEL))
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.{id(state)}.tmp")
+    tmp.write_bytes(pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL))
+    os.replace(tmp, path)  # Atomic, so a concurrent reader never sees a half-written file
+    return state
 
-def contains_any(text: str, phrases: List[str]) -> bool:
-    # Returns True if at least one phrase exists in the text (case-insensitive)
-    lower = text.lower()
-    return any(p.lower() in lower for p in phrases)
 
-
-def contains_all(text: str, phrases: List[str]) -> bool:
-    # Returns True only if all phrases exist in the text (case-insensitive)
-    lower = text.lower()
-    return all(p.lower() in lower for p in phrases)
+def word_count(text: str) -> int:
+    # Basic tokenizer-based word counting (used for length validation); counts matches
+    # without materializing them into a list
+    return sum(1 for _ in _WORD_RE.finditer(text))
+
+
+def casefold_all(phrases: List[str]) -> List[str]:
+    # Casefold a phrase list once (matching the casefolded output), so the matching helpers
+    # never re-fold and non-ASCII phrases compare correctly
+    return [p.casefold() for p in phrases]
+
+
+@functools.lru_cache(maxsize=64)
+def _automaton(lower_phrases: FrozenSet[str]) -> "ahocorasick.Automaton":
+    # Built once per distinct phrase set and reused by tests with the same check shape
+    automaton = ahocorasick.Automaton()
+    for p in lower_phrases:
+        automaton.add_word(p, p)
+    automaton.make_automaton()
+    return automaton
+
+
+def find_phrases(lower_text: str, lower_phrases: List[str]) -> Set[str]:
+    # Returns the subset of phrases present in the text (inputs already lowercased),
+    # in a single pass over the text when pyahocorasick is available
+    phrases = frozenset(p for p in lower_phrases if p)
+    found = {""} if "" in lower_phrases else set()  # The empty phrase trivially matches
+    if not phrases:
+        return found
+    if AHOCORASICK_AVAILABLE:
+        found.update(p for _, p in _automaton(phrases).iter(lower_text))
+    elif len(lower_text) >= BYTES_SEARCH_MIN_CHARS and lower_text.isascii():
+        # Long ASCII output: encode once and run the C-level bytes search per phrase
+        # (a non-ASCII phrase cannot occur in ASCII text)
+        text_bytes = lower_text.encode("ascii")
+        found.update(p for p in phrases if p.isascii() and p.encode("ascii") in text_bytes)
+    else:
+        found.update(p for p in phrases if p in lower_text)
+    return found
 
 
 # ----------------------------
 # Test Execution Logic
 # ----------------------------
+def _report(test: Dict, header: List[str], failures: List[str], output: str) -> Dict:
+    # Result record for a single test
+    return {
+        "header": header,
+        "id": test["id"],
+        "passed": len(failures) == 0,
+        "failures": failures,
+        "output_preview": output[:300],  # Truncated preview for easier debugging
+    }
+
+
 def evaluate_test(test: Dict) -> Dict:
-    # Execute a single test scenario and evaluate output against rules
+    # Execute a single test scenario and evaluate output against rules.
+    # Checks run cheapest first; with FAIL_FAST=1 the first failing check ends the evaluation.
     task = test["task"]
     checks = test.get("checks", {})
 
-    print(f"\n--- Running {test['id']} ---")
-    print(f"Task: {task}")
+    # Header lines are returned rather than printed, so parallel runs don't interleave output
+    header = [f"\n--- Running {test['id']} ---", f"Task: {task}"]
 
-    result = run_task(user_task=task, persist_dir=str(CHROMA_DIR))
-    state = normalize_state(result)
+    state = cached_run_task(task)
 
     # Use verified output if available, otherwise fallback to draft
     output = state.final_output or state.draft_output or ""
-    output_lower = output.lower()
+    output_lower = output.casefold()  # Computed once; every check below reuses it
 
     failures = []
 
+    # Explicit "not found" behavior enforcement when required
+    if checks.get("must_return_not_found"):
+        if not _NF_RE.search(output_lower):
+            failures.append("Expected 'Not found in sources' behavior.")
+            if FAIL_FAST:
+                return _report(test, header, failures, output)
+
+    # Scan the output once for every phrase across all check lists
+    must_include = checks.get("must_include", [])
+    must_not_include = checks.get("must_not_include", [])
+    must_include_any = checks.get("must_include_any", [])
+    include_lower = casefold_all(must_include)
+    exclude_lower = casefold_all(must_not_include)
+    any_lower = casefold_all(must_include_any)
+    found = find_phrases(output_lower, include_lower + exclude_lower + any_lower)
+
     # Required phrases validation
-    for phrase in checks.get("must_include", []):
-        if phrase.lower() not in output_lower:
+    for phrase, lower in zip(must_include, include_lower):
+        if lower not in found:
             failures.append(f"Missing required phrase: '{phrase}'")
 
     # Forbidden phrases validation
-    for phrase in checks.get("must_not_include", []):
-        if phrase.lower() in output_lower:
+    for phrase, lower in zip(must_not_include, exclude_lower):
+        if lower in found:
             failures.append(f"Contains forbidden phrase: '{phrase}'")
 
-    # At least one phrase from the provided list must appear
-    if "must_include_any" in checks:
-        if not contains_any(output, checks["must_include_any"]):
-            failures.append(
-                f"Must include at least one of: {checks['must_include_any']}"
-            )
+    if failures and FAIL_FAST:
+        return _report(test, header, failures, output)
 
-    # Word limit enforcement
+    # Word limit enforcement (tokenizes the whole output, so only when the check is present)
     if "max_words" in checks:
         wc = word_count(output)
         if wc > checks["max_words"]:
             failures.append(
                 f"Word count exceeded: {wc} > {checks['max_words']}"
             )
+            if FAIL_FAST:
+                return _report(test, header, failures, output)
 
-    # Explicit "not found" behavior enforcement when required
-    if checks.get("must_return_not_found"):
-        if "not found in sources" not in output_lower and "not documented" not in output_lower:
-            failures.append("Expected 'Not found in sources' behavior.")
-
-    passed = len(failures) == 0
+    # At least one phrase from the provided list must appear
+    if "must_include_any" in checks:
+        if not any(p in found for p in any_lower):
+            failures.append(
+                f"Must include at least one of: {checks['must_include_any']}"
+            )
 
-    return {
-        "id": test["id"],
-        "passed": passed,
-        "failures": failures,
-        "output_preview": output[:300],  # Truncated preview for easier debugging
-    }
+    return _report(test, header, failures, output)
 
 
 # ----------------------------
 # Entry Point
 # ----------------------------
 def main():
-    # Load test configuration and execute all scenarios sequentially
+    # Load test configuration and execute all scenarios in parallel
     if not TEST_FILE.exists():
         print("test_cases.json not found.")
         return
 
-    with open(TEST_FILE, "r", encoding="utf-8") as f:
-        tests = json.load(f)
+    if ORJSON_AVAILABLE:
+        tests = orjson.loads(TEST_FILE.read_bytes())
+    else:
+        with open(TEST_FILE, "r", encoding="utf-8") as f:
+            tests = json.load(f)
+
+    if LOCAL_EMBED:
+        # Incremental: only new or changed docs are embedded on subsequent runs
+        _, num = build_or_update_index(str(SAMPLE_DOCS_DIR), str(CHROMA_DIR))
+        print(f"Local-embedding index ready ({num} chunks embedded).")
+
+    # Tests are independent and dominated by network I/O (LLM, embeddings), so run them
+    # concurrently; all threads share the process-wide Chroma client
+    with ThreadPoolExecutor(max_workers=max(1, min(8, len(tests)))) as ex:
+        results = list(ex.map(evaluate_test, tests))
 
-    results = []
-    for test in tests:
-        res = evaluate_test(test)
-        results.append(res)
+    # Single pass: print each result and tally passes as we go
+    passed = 0
+    for res in results:
+        for line in res["header"]:
+            print(line)
 
         if res["passed"]:
+            passed += 1
             print("✅ PASS")
         else:
             print("❌ FAIL")
@@ -136,7 +284,6 @@ def main():
             print("------------------------\n")
 
     total = len(results)
-    passed = sum(r["passed"] for r in results)
 
     print("\n==============================")
     print(f"FINAL SCORE: {passed}/{total} passed")
@@ -1,36 +1,53 @@
 from __future__ import annotations 
 
-from pydantic import BaseModel, Field
-from typing import Any, Dict, List, Literal, Optional
+import time
+import msgspec
+from pydantic import BaseModel, ConfigDict, Field
+from typing import Any, Dict, Iterable, List, Literal, Optional
 from datetime import datetime, timezone
 
 
-class AgentLogEntry(BaseModel):
+# Plain-data records are msgspec Structs: construction skips validation entirely, which matters
+# for objects created on every agent step. AppState and ResearchNotes stay Pydantic.
+
+class AgentLogEntry(msgspec.Struct):
     # Single trace entry for agent actions (who did what, when, and with what outcome)
-    timestamp: str
     agent: str
     action: str
     outcome: str
+    timestamp_ns: int = msgspec.field(default_factory=time.time_ns)  # UTC epoch nanoseconds
+
+    @property
+    def timestamp(self) -> str:
+        # ISO-8601 UTC string, formatted only when a trace is actually rendered
+        return datetime.fromtimestamp(self.timestamp_ns / 1e9, tz=timezone.utc).isoformat()
 
     @staticmethod
     def now(agent: str, action: str, outcome: str) -> "AgentLogEntry":
         # Convenience constructor that stamps the log entry with current UTC time
-        return AgentLogEntry(
-            timestamp=datetime.now(timezone.utc).isoformat(),
-            agent=agent,
-            action=action,
-            outcome=outcome,
-        )
+        return AgentLogEntry(agent=agent, action=action, outcome=outcome, timestamp_ns=time.time_ns())
 
 
-class Citation(BaseModel):
+class Citation(msgspec.Struct, frozen=True):
     # Source reference attached to facts (doc identity, location, and supporting snippet)
+    # frozen=True makes instances hashable by value, so they dedupe directly in a set
     doc_id: str
     location: str
     snippet: str
 
 
-class ResearchFact(BaseModel):
+def dedupe_citations(citations: Optional[Iterable[Citation]]) -> List[Citation]:
+    # Remove duplicate citations in O(N), preserving first-seen order
+    seen = set()
+    out = []
+    for c in citations or []:
+        if c not in seen:
+            seen.add(c)
+            out.append(c)
+    return out
+
+
+class ResearchFact(msgspec.Struct):
     # A single grounded fact plus its supporting citations
     fact: str
     citations: List[Citation]
@@ -38,16 +55,22 @@ class ResearchFact(BaseModel):
 
 class ResearchNotes(BaseModel):
     # Research outcome: either evidence was found ("ok") or not present in sources
+    model_config = ConfigDict(arbitrary_types_allowed=True)  # Struct fields are isinstance-checked only
+
     status: Literal["ok", "Not found in sources"]
     facts: List[ResearchFact] = Field(default_factory=list)
 
 
 class AppState(BaseModel):
+    model_config = ConfigDict(arbitrary_types_allowed=True, validate_assignment=False)
+
     # Inputs
     user_task: str = ""
 
     # Orchestration artifacts (planner output)
-    plan: List[str] = Field(default_factory=list)
+    # plan/citations/agent_logs default to None rather than empty lists, so states that never
+    # reach those agents don't allocate them; read them as `state.plan or []`
+    plan: Optional[List[str]] = None
 
     # Research artifacts (researcher output)
     research_notes: Optional[ResearchNotes] = None
@@ -59,18 +82,35 @@ class AppState(BaseModel):
     final_output: Optional[str] = None
 
     # Flattened citations for display/reporting (optional convenience)
-    citations: List[Citation] = Field(default_factory=list)
+    citations: Optional[List[Citation]] = None
 
     # Traceability: chronological agent logs
-    agent_logs: List[AgentLogEntry] = Field(default_factory=list)
+    agent_logs: Optional[List[AgentLogEntry]] = None
 
     # Controls for verifier retry/reroute loop
     verifier_fail_count: int = 0
     verifier_max_retries: int = 2
 
-    # Extra metadata (model name, persist_dir, observability, etc.)
+    # Observability, stored column-wise (one list per field) so it feeds st.dataframe directly
+    observability: Dict[str, List[Any]] = Field(
+        default_factory=lambda: {"agent": [], "latency_s": [], "error": []}
+    )
+
+    # Extra metadata (model name, persist_dir, etc.)
     meta: Dict[str, Any] = Field(default_factory=dict)
 
     def log(self, agent: str, action: str, outcome: str) -> None:
         # Append a standardized log entry to the state
-        self.agent_logs.append(AgentLogEntry.now(agent, action, outcome))
+        self.ensure_agent_logs().append(AgentLogEntry.now(agent, action, outcome))
+
+    def ensure_agent_logs(self) -> List[AgentLogEntry]:
+        # Allocate the log list on first use
+        if self.agent_logs is None:
+            self.agent_logs = []
+        return self.agent_logs
+
+    def record_obs(self, agent: str, t0: float, error: Optional[str] = None) -> None:
+        # Append one observability row; t0 comes from time.perf_counter()
+        self.observability["agent"].append(agent)
+        self.observability["latency_s"].append(round(time.perf_counter() - t0, 3))
+        self.observability["error"].append(error)
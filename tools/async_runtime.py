@@ -0,0 +1,56 @@
+from __future__ import annotations 
+
+import asyncio
+import concurrent.futures
+import threading
+from typing import AsyncIterator, Awaitable, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+
+# One event loop per process, running on a daemon thread. Cached async clients (ChatOpenAI's
+# httpx pool, etc.) bind their connections to the loop that opened them, so every coroutine
+# must run here instead of on a fresh asyncio.run()/new_event_loop() per call.
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_lock = threading.Lock()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    # Start the shared loop on first use
+    global _loop
+    with _lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="async-runtime", daemon=True).start()
+            _loop = loop
+        return _loop
+
+
+def run(coro: Awaitable[T]) -> T:
+    # Run a coroutine on the shared loop and block the calling (sync) thread for its result
+    loop = get_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        raise RuntimeError("run() called from the shared loop; await the coroutine instead")
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
+def submit(coro: Awaitable[T]) -> "concurrent.futures.Future[T]":
+    # Schedule a coroutine on the shared loop without waiting for it
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+def iterate(agen: AsyncIterator[T]) -> Iterator[T]:
+    # Drive an async generator on the shared loop from sync code (e.g. st.write_stream)
+    try:
+        while True:
+            try:
+                yield run(agen.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        aclose = getattr(agen, "aclose", None)
+        if aclose is not None:
+            run(aclose())
@@ -0,0 +1,139 @@
+from __future__ import annotations 
+
+import asyncio
+import concurrent.futures
+import math
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from schemas.state import AppState
+from tools.retriever import get_embeddings
+
+
+@dataclass(eq=False)
+class InFlightTask:
+    # A running workflow that near-duplicate requests may attach to
+    user_task: str
+    persist_dir: str
+    model: str
+    started: float = field(default_factory=time.monotonic)
+    future: concurrent.futures.Future = field(default_factory=concurrent.futures.Future)
+    embedding: Optional[List[float]] = None  # Computed lazily, only once another request needs it
+
+
+def _cosine(a: List[float], b: List[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+class TaskCoalescer:
+    """
+    Lets concurrent, near-duplicate user tasks share one workflow execution.
+    A request whose task embedding is within `threshold` cosine similarity of a task that
+    started less than `window_s` seconds ago (same persist_dir and model) waits for that
+    run's result instead of starting its own. Works across Streamlit sessions, which run
+    on separate threads and event loops.
+    """
+
+    def __init__(self, threshold: float = 0.97, window_s: float = 10.0):
+        self.threshold = threshold
+        self.window_s = window_s
+        self._lock = threading.Lock()
+        self._inflight: List[InFlightTask] = []
+        self.requests_total = 0
+        self.coalesced_total = 0
+
+    @property
+    def merge_rate(self) -> float:
+        return self.coalesced_total / self.requests_total if self.requests_total else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "requests_total": self.requests_total,
+            "coalesced_total": self.coalesced_total,
+            "merge_rate": round(self.merge_rate, 3),
+        }
+
+    def _match(self, user_task: str, persist_dir: str, model: str) -> Optional[InFlightTask]:
+        now = time.monotonic()
+        with self._lock:
+            candidates = [
+                t for t in self._inflight
+                if t.persist_dir == persist_dir and t.model == model and now - t.started <= self.window_s
+            ]
+        if not candidates:
+            return None  # Common single-user case: no embedding call at all
+
+        for t in candidates:
+            if t.user_task == user_task:
+                return t
+
+        # Coalescing is only an optimization: any embedding error (rate limit, network) means
+        # "no match", never a failed request
+        try:
+            embeddings = get_embeddings()
+            vec = embeddings.embed_query(user_task)
+        except Exception:
+            return None
+        for t in candidates:
+            if t.embedding is None:
+                try:
+                    t.embedding = embeddings.embed_query(t.user_task)
+                except Exception:
+                    continue
+            if _cosine(vec, t.embedding) >= self.threshold:
+                return t
+        return None
+
+    async def acquire(self, user_task: str, persist_dir: str, model: str) -> Tuple[bool, InFlightTask]:
+        # Returns (is_leader, task); a leader must call release() when its run finishes
+        match = await asyncio.to_thread(self._match, user_task, persist_dir, model)
+        with self._lock:
+            self.requests_total += 1
+            if match is not None:
+                self.coalesced_total += 1
+                return False, match
+            task = InFlightTask(user_task=user_task, persist_dir=persist_dir, model=model)
+            self._inflight.append(task)
+            return True, task
+
+    def release(self, task: InFlightTask, result: Optional[AppState] = None, error: Optional[BaseException] = None) -> None:
+        with self._lock:
+            if task in self._inflight:
+                self._inflight.remove(task)
+        if error is not None:
+            # Cancellation of the leader should surface as an ordinary error for followers
+            if not isinstance(error, Exception):
+                error = RuntimeError("coalesced run was cancelled")
+            task.future.set_exception(error)
+        else:
+            task.future.set_result(result)
+
+    async def wait(self, task: InFlightTask, user_task: str) -> AppState:
+        # Followers get their own copy, so sessions never mutate a shared state
+        result: AppState = await asyncio.wrap_future(task.future)
+        state = result.model_copy(deep=True)
+        state.user_task = user_task
+        state.log("coalescer", "joined in-flight task", f"shared result of: {task.user_task[:80]}")
+        return state
+
+    async def run(
+        self, user_task: str, persist_dir: str, model: str, factory: Callable[[], Awaitable[AppState]]
+    ) -> AppState:
+        leader, task = await self.acquire(user_task, persist_dir, model)
+        if not leader:
+            return await self.wait(task, user_task)
+        try:
+            result = await factory()
+        except BaseException as e:
+            self.release(task, error=e)
+            raise
+        self.release(task, result=result)
+        return result
+
+
+# Shared by every session in the process
+coalescer = TaskCoalescer()
@@ -0,0 +1,89 @@
+from __future__ import annotations 
+
+import os
+import json
+import mmap
+import hashlib
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional
+
+try:
+    import blake3
+    BLAKE3_AVAILABLE = True  # SIMD-accelerated hashing if the optional package is installed
+except Exception:
+    BLAKE3_AVAILABLE = False
+
+
+# Stat-keyed content hashes, stored next to the index they describe
+HASH_CACHE_NAME = ".hashcache.json"
+
+HashCache = Dict[str, Dict[str, object]]
+
+
+def _new_hasher():
+    # BLAKE3 when available, SHA-256 otherwise
+    return blake3.blake3() if BLAKE3_AVAILABLE else hashlib.sha256()
+
+
+def hash_file(p: Path) -> str:
+    # Hash file contents via mmap (no Python-level chunk loop) for stable fingerprints
+    h = _new_hasher()
+    with p.open("rb") as f:
+        if os.fstat(f.fileno()).st_size:  # mmap cannot map empty files
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                h.update(mm)
+    return h.hexdigest()
+
+
+def load_hash_cache(cache_dir: str) -> HashCache:
+    # Per-file hashes keyed by path, valid while (mtime_ns, size) are unchanged
+    try:
+        with open(os.path.join(cache_dir, HASH_CACHE_NAME), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_json_atomic(path: str, obj: Any, **dump_kwargs: Any) -> None:
+    # Write to a temp file in the same directory, then rename over the target, so concurrent
+    # readers see either the old or the new file, never a partial one
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(obj, f, **dump_kwargs)
+    os.replace(tmp, path)
+
+
+def save_hash_cache(cache_dir: str, cache: HashCache) -> None:
+    os.makedirs(cache_dir, exist_ok=True)
+    write_json_atomic(os.path.join(cache_dir, HASH_CACHE_NAME), cache, sort_keys=True)
+
+
+def cached_hash(p: Path, cache: HashCache) -> str:
+    # Content hash of `p`, recomputed only when its stat signature changed since it was cached
+    info = p.stat()
+    key = str(p)
+    entry = cache.get(key)
+    if not entry or entry["mtime_ns"] != info.st_mtime_ns or entry["size"] != info.st_size:
+        entry = {"mtime_ns": info.st_mtime_ns, "size": info.st_size, "hash": hash_file(p)}
+        cache[key] = entry
+    return entry["hash"]
+
+
+def prune_hash_cache(cache: HashCache, live: Iterable[str]) -> None:
+    # Drop entries for files that no longer exist
+    live = set(live)
+    for key in [k for k in cache if k not in live]:
+        del cache[key]
+
+
+def hash_files(paths: Iterable[Path], cache_dir: Optional[str] = None) -> Dict[str, str]:
+    # Map each path to its content hash, going through (and updating) the on-disk stat cache
+    cache = load_hash_cache(cache_dir) if cache_dir else {}
+    before = dict(cache)
+    hashes = {str(p): cached_hash(p, cache) for p in paths}
+    if cache_dir:
+        prune_hash_cache(cache, hashes)
+        if cache != before:  # Only rewrite when a file was (re)hashed or removed
+            save_hash_cache(cache_dir, cache)
+    return hashes
@@ -0,0 +1,112 @@
+from __future__ import annotations 
+
+import asyncio
+import concurrent.futures
+import functools
+import hashlib
+import json
+import threading
+import weakref
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Sequence, Type
+
+from pydantic import BaseModel
+
+from langchain_openai import ChatOpenAI
+from langchain_core.messages import BaseMessage
+from langchain_core.rate_limiters import InMemoryRateLimiter
+from langchain_core.runnables import Runnable
+
+
+@functools.lru_cache(maxsize=8)
+def get_llm(model: str, streaming: bool = False) -> ChatOpenAI:
+    # One deterministic client per model, reused across agents, requests and sessions
+    return ChatOpenAI(model=model, temperature=0, timeout=60, max_retries=2, streaming=streaming)
+
+
+@functools.lru_cache(maxsize=16)
+def get_structured(model: str, schema: Type[BaseModel]) -> Runnable:
+    # Structured-output wrapper built once per (model, schema) instead of per call.
+    # Strict json_schema mode makes the server constrain decoding to the schema, so
+    # responses always parse and no tool definition is added to the prompt
+    return get_llm(model).with_structured_output(schema, method="json_schema", strict=True)
+
+
+class LLMBatcher:
+    """
+    Process-wide front door for structured agent LLM calls.
+    Identical in-flight requests (same model, schema and messages) are coalesced into one
+    API call, even across Streamlit sessions running on different threads/event loops.
+    A concurrency cap and a token-bucket rate limit keep concurrent sessions within quota;
+    calls that bypass submit() (the writer's streaming call) take the same budget via slot().
+    """
+
+    def __init__(self, max_concurrency: int = 10, requests_per_minute: int = 100):
+        self._max_concurrency = max_concurrency
+        # asyncio semaphores are FIFO and wake waiters directly; one per loop, since a semaphore
+        # can't be shared across loops (in the app and eval everything runs on the shared loop)
+        self._slots: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = (
+            weakref.WeakKeyDictionary()
+        )
+        self._rate_limiter = InMemoryRateLimiter(
+            requests_per_second=requests_per_minute / 60,
+            check_every_n_seconds=0.05,
+            max_bucket_size=max_concurrency,
+        )
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, concurrent.futures.Future] = {}
+
+    @staticmethod
+    def _key(model: str, schema: Type[BaseModel], messages: Sequence[BaseMessage]) -> str:
+        payload = json.dumps(
+            [model, schema.__qualname__, [(m.type, m.content) for m in messages]],
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def submit(self, model: str, messages: Sequence[BaseMessage], schema: Type[BaseModel]) -> Any:
+        # Return the structured output for `messages`, sharing the call with identical in-flight requests
+        key = self._key(model, schema, messages)
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = concurrent.futures.Future()
+                self._inflight[key] = future
+
+        if not leader:
+            # concurrent.futures.Future is thread-safe, unlike asyncio.Future
+            return await asyncio.wrap_future(future)
+
+        try:
+            result = await self._call(model, messages, schema)
+        except BaseException as e:
+            # Followers in other sessions must not inherit the leader's cancellation
+            future.set_exception(e if isinstance(e, Exception) else RuntimeError("coalesced LLM call was cancelled"))
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        # Rate-limit token plus one concurrency slot for the duration of an LLM call
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            slots = self._slots.get(loop)
+            if slots is None:
+                slots = self._slots[loop] = asyncio.Semaphore(self._max_concurrency)
+        await self._rate_limiter.aacquire()
+        async with slots:
+            yield
+
+    async def _call(self, model: str, messages: Sequence[BaseMessage], schema: Type[BaseModel]) -> Any:
+        async with self.slot():
+            return await get_structured(model, schema).ainvoke(messages)
+
+
+# Shared by every agent in the process
+batcher = LLMBatcher()
@@ -1,17 +1,24 @@
 from __future__ import annotations 
 
 import os
-from typing import List, Tuple
-import shutil
+import json
+import functools
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import chromadb
+from chromadb.api.client import SharedSystemClient
 from langchain_chroma import Chroma
 from langchain_openai import OpenAIEmbeddings
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
-from langchain_community.document_loaders import (
-    DirectoryLoader,
-    TextLoader,
-)
+from langchain_community.document_loaders import TextLoader
+
+from tools.file_hashes import hash_files, write_json_atomic
 
 try:
     from langchain_community.document_loaders import PyPDFLoader
@@ -20,114 +27,259 @@ except Exception:
     PDF_AVAILABLE = False
 
 
+def _source_paths(sample_docs_dir: str, files: Optional[Iterable[Path]] = None) -> List[Path]:
+    # Single recursive pass collecting both file types (hidden paths skipped, as DirectoryLoader did);
+    # callers that already listed the tree pass `files` and skip the walk
+    root = Path(sample_docs_dir)
+    if files is None:
+        files = (p for p in root.rglob("*") if p.is_file())
+    paths: List[Path] = []
+    for p in sorted(files):
+        if any(part.startswith(".") for part in p.relative_to(root).parts):
+            continue
+        if p.suffix == ".txt" or (PDF_AVAILABLE and p.suffix.lower() == ".pdf"):
+            paths.append(p)
+    return paths
+
+
+def _load_paths(paths: List[Path]) -> List[Document]:
+    if not paths:
+        return []
+
+    def load(p: Path) -> List[Document]:
+        if p.suffix == ".txt":
+            return TextLoader(str(p), encoding="utf-8").load()
+        return PyPDFLoader(str(p)).load()
+
+    # Files are independent; parse them in parallel, keeping path order
+    docs: List[Document] = []
+    with ThreadPoolExecutor(max_workers=min(8, len(paths))) as ex:
+        for loaded in ex.map(load, paths):
+            docs.extend(loaded)
+    return docs
+
+
 def _load_documents(sample_docs_dir: str) -> List[Document]:
     """
     Loads documents from data/sample_docs/.
     Supports .txt by default; supports PDF if pypdf and PyPDFLoader are installed.
     """
-    docs: List[Document] = []
+    return _load_paths(_source_paths(sample_docs_dir))
 
-    # Load text files recursively from the directory
-    txt_loader = DirectoryLoader(
-        sample_docs_dir,
-        glob="**/*.txt",
-        loader_cls=TextLoader,
-        loader_kwargs={"encoding": "utf-8"},
-        show_progress=False,
-        use_multithreading=True,
-    )
-    docs.extend(txt_loader.load())
-
-    # Load PDFs if the optional PDF loader is available
-    if PDF_AVAILABLE:
-        pdf_paths: List[str] = []
-        for root, _, files in os.walk(sample_docs_dir):
-            for f in files:
-                if f.lower().endswith(".pdf"):
-                    pdf_paths.append(os.path.join(root, f))
-        for path in pdf_paths:
-            loader = PyPDFLoader(path)
-            docs.extend(loader.load())
 
-    return docs
+# Shared splitter; it is stateless per call, so one instance serves every rebuild
+_SPLITTER = RecursiveCharacterTextSplitter(
+    chunk_size=700,
+    chunk_overlap=120,
+    separators=["\n\n", "\n", " ", ""],
+)
 
 
 def _split_documents(docs: List[Document]) -> List[Document]:
     # Split documents into overlapping chunks for retrieval
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=700,
-        chunk_overlap=120,
-        separators=["\n\n", "\n", " ", ""],
-    )
-    split_docs = splitter.split_documents(docs)
+    split_docs = _SPLITTER.split_documents(docs)
 
     # Attach stable citation metadata for traceability in downstream agents
-    per_doc_counter = {}
+    per_doc_counter = defaultdict(int)
+    basename = os.path.basename  # Local alias; this loop runs once per chunk
     for global_i, d in enumerate(split_docs):
-        src = d.metadata.get("source", "unknown_source")
-        doc_id = os.path.basename(src)
+        md = d.metadata
+        doc_id = basename(md.get("source", "unknown_source"))
 
-        per_doc_counter.setdefault(doc_id, 0)
         local_i = per_doc_counter[doc_id]
-        per_doc_counter[doc_id] += 1
+        per_doc_counter[doc_id] = local_i + 1
 
-        page = d.metadata.get("page", None)
-        d.metadata["doc_id"] = doc_id
-        d.metadata["chunk_id"] = local_i
-        d.metadata["global_chunk_id"] = global_i
+        md["doc_id"] = doc_id
+        md["chunk_id"] = local_i
+        md["global_chunk_id"] = global_i
 
         # Human-readable location string used by citations (page/chunk if available)
-        if page is not None:
-            d.metadata["location"] = f"page {page}, chunk {local_i}"
-        else:
-            d.metadata["location"] = f"chunk {local_i}"
+        page = md.get("page")
+        md["location"] = f"page {page}, chunk {local_i}" if page is not None else f"chunk {local_i}"
 
     return split_docs
 
 
-def get_vectorstore(
-    persist_dir: str,
-    collection_name: str = "supplychain_copilot",
-) -> Chroma:
+# HNSW parameters applied when a collection is created (cosine space, higher build quality,
+# explicit query-time ef to pin the recall/latency trade-off)
+HNSW_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:construction_ef": 200,
+    "hnsw:M": 32,
+    "hnsw:search_ef": 64,
+}
+
+
+@functools.lru_cache(maxsize=4)
+def _client(persist_dir: str) -> chromadb.ClientAPI:
+    # One persistent client per directory, instead of reopening the store on every query
+    os.makedirs(persist_dir, exist_ok=True)
+    return chromadb.PersistentClient(path=persist_dir)
+
+
+# Local sentence-transformers model used instead of OpenAI when EVAL_LOCAL_EMBED is set
+LOCAL_EMBED_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+
+@functools.lru_cache(maxsize=1)
+def get_embeddings() -> Embeddings:
+    # Shared embeddings client (keeps its HTTP connection pool warm)
+    if os.getenv("EVAL_LOCAL_EMBED"):
+        # Eval runs: embed on the local CPU/GPU, no network round trip per query
+        from langchain_community.embeddings import HuggingFaceEmbeddings
+
+        return HuggingFaceEmbeddings(
+            model_name=LOCAL_EMBED_MODEL,
+            model_kwargs={"device": os.getenv("EVAL_EMBED_DEVICE", "cpu")},
+            encode_kwargs={"batch_size": 64, "normalize_embeddings": True},
+        )
+    return OpenAIEmbeddings()
+
+
+# Chunks per add_documents call (Chroma recommends inserting in batches of ~50-250 records)
+ADD_BATCH_SIZE = 200
+
+# Serializes store construction so parallel callers (eval workers, agent threads) share one instance
+_VS_LOCK = threading.Lock()
+
+
+def reset_clients() -> None:
+    # Drop cached Chroma clients and stores; call before deleting a persist directory from disk
+    with _VS_LOCK:
+        _retriever.cache_clear()
+        _vectorstore.cache_clear()
+        _client.cache_clear()
+        SharedSystemClient.clear_system_cache()
+
+
+@functools.lru_cache(maxsize=8)
+def _vectorstore(persist_dir: str, collection_name: str) -> Chroma:
     # Create/load a persistent Chroma collection with OpenAI embeddings
-    embeddings = OpenAIEmbeddings()
     return Chroma(
+        client=_client(persist_dir),
         collection_name=collection_name,
-        embedding_function=embeddings,
-        persist_directory=persist_dir,
+        embedding_function=get_embeddings(),
+        collection_metadata=HNSW_METADATA,
     )
 
 
+def get_vectorstore(
+    persist_dir: str,
+    collection_name: str = "supplychain_copilot",
+) -> Chroma:
+    # Cached per (persist_dir, collection_name) so queries do not reopen the store each time
+    with _VS_LOCK:
+        return _vectorstore(persist_dir, collection_name)
+
+
+def get_collection(persist_dir: str, collection_name: str) -> chromadb.Collection:
+    # Raw Chroma collection, for callers that supply their own embeddings
+    return _client(persist_dir).get_or_create_collection(collection_name, metadata=HNSW_METADATA)
+
+
+@functools.lru_cache(maxsize=32)
+def _retriever(persist_dir: str, collection_name: str, k: int):
+    # One retriever per k (retries widen k, so only a handful of values ever occur)
+    return get_vectorstore(persist_dir, collection_name).as_retriever(search_kwargs={"k": k})
+
+
+def _embedder_id() -> str:
+    # Identifies the embedding model; vectors from different embedders cannot share a collection
+    emb = get_embeddings()
+    return f"{type(emb).__name__}:{getattr(emb, 'model', None) or getattr(emb, 'model_name', '')}"
+
+
+def _manifest_path(persist_dir: str, collection_name: str) -> str:
+    return os.path.join(persist_dir, f"{collection_name}.manifest.json")
+
+
+def _load_manifest(persist_dir: str, collection_name: str) -> Dict[str, Any]:
+    try:
+        with open(_manifest_path(persist_dir, collection_name), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def _save_manifest(persist_dir: str, collection_name: str, manifest: Dict[str, Any]) -> None:
+    write_json_atomic(_manifest_path(persist_dir, collection_name), manifest, indent=2)
+
+
+# One index sync at a time: every Streamlit session calls build_or_update_index on submit
+_INDEX_LOCK = threading.Lock()
+
+
+def _chunk_ids(source: str, n: int) -> List[str]:
+    # Deterministic ids let a changed or removed file's chunks be deleted without a query
+    return [f"{source}#{i}" for i in range(n)]
+
+
 def build_or_update_index(
     sample_docs_dir: str,
     persist_dir: str,
     collection_name: str = "supplychain_copilot",
+    files: Optional[Iterable[Path]] = None,
 ) -> Tuple[Chroma, int]:
     """
-    Rebuilds the Chroma index from scratch every time (prevents duplicates).
-    Returns (vectorstore, num_chunks_indexed).
+    Incrementally syncs the Chroma index with the docs on disk.
+    A manifest (source path -> content hash, chunk count) tracks what is indexed, so only new or
+    changed files are embedded and removed files are deleted. Falls back to a full rebuild
+    when there is no manifest or the embedder changed.
+    `files` is an optional pre-computed listing of sample_docs_dir (saves re-walking the tree).
+    Returns (vectorstore, num_chunks_indexed) for this call.
     """
     os.makedirs(sample_docs_dir, exist_ok=True)
+    with _INDEX_LOCK:
+        return _sync_index(sample_docs_dir, persist_dir, collection_name, files)
 
-    raw_docs = _load_documents(sample_docs_dir)
-    if not raw_docs:
-        os.makedirs(persist_dir, exist_ok=True)
-        vs = get_vectorstore(persist_dir, collection_name)
-        return vs, 0
 
-    # Remove existing persistent index to avoid duplicate chunks across rebuilds
-    if os.path.isdir(persist_dir):
-        shutil.rmtree(persist_dir)
-    os.makedirs(persist_dir, exist_ok=True)
+def _sync_index(
+    sample_docs_dir: str, persist_dir: str, collection_name: str, files: Optional[Iterable[Path]]
+) -> Tuple[Chroma, int]:
+    vs = get_vectorstore(persist_dir, collection_name)
+    # Content hashes come from the stat-keyed cache, so unchanged files are not re-read
+    paths = _source_paths(sample_docs_dir, files)
+    hashes = hash_files(paths, persist_dir)
+    current = {str(p): (p, hashes[str(p)]) for p in paths}
 
-    split_docs = _split_documents(raw_docs)
+    embedder = _embedder_id()
+    manifest = _load_manifest(persist_dir, collection_name)
+    indexed: Dict[str, Dict[str, Any]] = manifest.get("files", {})
+    rebuild = manifest.get("embedder") != embedder
+    if rebuild:
+        # Unknown contents (legacy build) or incompatible vectors: start from an empty collection
+        vs.reset_collection()
+        indexed = {}
 
-    # Create a fresh vectorstore and add chunked documents
-    vs = get_vectorstore(persist_dir, collection_name)
-    vs.add_documents(split_docs)
+    changed = [src for src, (_, digest) in current.items() if indexed.get(src, {}).get("hash") != digest]
+    stale = [src for src in indexed if src not in current or src in changed]
+    if not (rebuild or changed or stale):
+        return vs, 0  # Index already matches the docs; leave the manifest untouched
+
+    stale_ids = [i for src in stale for i in _chunk_ids(src, indexed[src]["chunks"])]
+    for i in range(0, len(stale_ids), ADD_BATCH_SIZE):
+        vs.delete(ids=stale_ids[i:i + ADD_BATCH_SIZE])
+
+    split_docs = _split_documents(_load_paths([current[src][0] for src in changed]))
+
+    # Number chunks per source file so ids match the manifest's chunk counts
+    counts: Dict[str, int] = defaultdict(int)
+    ids: List[str] = []
+    for d in split_docs:
+        src = d.metadata.get("source", "unknown_source")
+        ids.append(f"{src}#{counts[src]}")
+        counts[src] += 1
+
+    for i in range(0, len(split_docs), ADD_BATCH_SIZE):
+        vs.add_documents(split_docs[i:i + ADD_BATCH_SIZE], ids=ids[i:i + ADD_BATCH_SIZE])
+
+    files = {src: indexed[src] for src in current if src not in changed}
+    files.update({src: {"hash": current[src][1], "chunks": counts[src]} for src in changed})
+    _save_manifest(persist_dir, collection_name, {"embedder": embedder, "files": files})
 
     return vs, len(split_docs)
 
+
 def retrieve(
     query: str,
     persist_dir: str,
@@ -137,20 +289,19 @@ def retrieve(
     """
     Retrieve top-k docs from persistent Chroma store.
     """
-    vs = get_vectorstore(persist_dir, collection_name)
-    retriever = vs.as_retriever(search_kwargs={"k": k})
+    # Over-fetch so deduplication can still fill k slots
+    retriever = _retriever(persist_dir, collection_name, k * 2)
 
     # Newer LangChain retrievers are Runnables
     docs = retriever.invoke(query)
 
-    # Deduplicate results by (doc_id, location) to avoid repeated chunks
+    # Deduplicate results by (doc_id, location) to avoid repeated chunks, keeping rank order
     seen = set()
-    unique = []
-    for d in docs:
-        key = (d.metadata.get("doc_id"), d.metadata.get("location"))
-        if key not in seen:
-            seen.add(key)
-            unique.append(d)
+    unique = [
+        d for d in docs
+        if (key := (d.metadata.get("doc_id"), d.metadata.get("location"))) not in seen
+        and not seen.add(key)
+    ]
 
     # Back-compat: ensure list[Document]
-    return unique
+    return unique[:k]
@@ -0,0 +1,90 @@
+from __future__ import annotations 
+
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from tools.retriever import get_collection, get_embeddings
+
+
+CACHE_COLLECTION = "agent_cache"
+
+# Cosine distance (see HNSW_METADATA); 0.025 corresponds to a cosine similarity of 0.975
+MAX_DISTANCE = 0.025
+
+# Writes happen off the request path; one worker keeps them ordered
+_STORE_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="semcache")
+
+
+def enabled() -> bool:
+    # SEMCACHE_DISABLED=1 bypasses the cache (read per call, so tests/eval can flip it at runtime)
+    return os.getenv("SEMCACHE_DISABLED") != "1"
+
+
+def _context_key(agent: str, model: str, context: str) -> str:
+    # Exact-match part of the key: everything in the prompt except the user task
+    return hashlib.sha256(f"{agent}|{model}|{context}".encode("utf-8")).hexdigest()
+
+
+def lookup(
+    persist_dir: str, agent: str, model: str, user_task: str, context: str = ""
+) -> Tuple[Optional[str], Optional[List[float]]]:
+    """
+    Return (cached JSON response or None, user task embedding).
+    Only entries whose agent/model/context match exactly are considered. Pass the embedding
+    back to store()/store_background() so a miss costs a single embedding call.
+    """
+    if not enabled():
+        return None, None
+    try:
+        vector = get_embeddings().embed_query(user_task)
+    except Exception:
+        return None, None  # The cache must never break the pipeline
+    try:
+        res = get_collection(persist_dir, CACHE_COLLECTION).query(
+            query_embeddings=[vector],
+            n_results=1,
+            where={"context_key": _context_key(agent, model, context)},
+            include=["metadatas", "distances"],
+        )
+    except Exception:
+        return None, vector
+
+    if not res["ids"] or not res["ids"][0]:
+        return None, vector
+    if res["distances"][0][0] > MAX_DISTANCE:
+        return None, vector
+    return res["metadatas"][0][0].get("value"), vector
+
+
+def store(
+    persist_dir: str,
+    agent: str,
+    model: str,
+    user_task: str,
+    value: str,
+    context: str = "",
+    vector: Optional[List[float]] = None,
+) -> None:
+    # Upsert the response JSON keyed by the user task embedding plus the exact context key
+    key = _context_key(agent, model, context)
+    if not enabled():
+        return
+    entry_id = hashlib.sha256(f"{key}|{user_task}".encode("utf-8")).hexdigest()
+    try:
+        if vector is None:
+            vector = get_embeddings().embed_query(user_task)
+        get_collection(persist_dir, CACHE_COLLECTION).upsert(
+            ids=[entry_id],
+            embeddings=[vector],
+            documents=[user_task],
+            metadatas=[{"agent": agent, "context_key": key, "value": value}],
+        )
+    except Exception:
+        pass
+
+
+def store_background(*args, **kwargs) -> None:
+    # Fire-and-forget store(); callers return their result without waiting on the write
+    _STORE_POOL.submit(store, *args, **kwargs)